@@ -5,15 +5,29 @@
 #Plots reaction profiles using matplotlib by reading in energies from a file.
 #See the readme.md file for more information
 
+from __future__ import print_function
 from profile_plotter_helpers import *
 
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.offsetbox import AnnotationBbox, OffsetImage
 import matplotlib.path as Path
 
 import argparse
+import copy
+import sys
+import threading
+import time
+from collections import deque
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 from os import path
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
 
 class PlotEntry:
@@ -24,6 +38,7 @@ class PlotEntry:
         self.add_connected(connected_to)
         self.colour = self.add_colour(colour.strip())
         self.energy = self.add_energy(energy)
+        self.inenergy = self.energy
         self.image = self.check_image(image)
         self.text = text[:20].strip()
 
@@ -41,8 +56,9 @@ class PlotEntry:
 
     def check_image(self, image):
         """
-        Ensure the plot file exists.. Maybe change to checking for image file?
+        Ensure the image file exists, ignoring quotes around the name.
         """
+        image = image.strip().strip('"')
         if image != "" and check_files_exist([image]):
             return image
         return None
@@ -52,7 +68,7 @@ class PlotEntry:
         if is_positive_int(number):
             return int(number)
         else:
-            print "Number {} not valid.".format(number)
+            print("Number {} not valid.".format(number))
             raise FormatError(number, "Number {} not valid.".format(number))
 
     def add_connected(self, connection):
@@ -68,6 +84,30 @@ class PlotEntry:
             raise FormatError(eng, "Energy {} not valid.".format(eng))
 
 
+class OverlapReport:
+    """Holds the outcome of resolving overlapping text on a plot"""
+    def __init__(self):
+        self.passes = 0
+        self.candidates = 0
+        self.pair_checks = 0
+        self.converged = False
+        self.timed_out = False
+        self.oscillating = list()
+        self.remaining = list()
+
+    def __str__(self):
+        if self.converged and not self.remaining:
+            return "Labels placed in {} passes.".format(self.passes)
+        msg = "{} overlapping labels remain after {} passes".format(
+            len(self.remaining), self.passes)
+        if self.timed_out:
+            msg = ("Out of time after {} passes, at least {} overlapping "
+                   "labels remain".format(self.passes, len(self.remaining)))
+        if self.oscillating:
+            msg += ", {} pairs oscillating".format(len(self.oscillating))
+        return msg + ". Check the plot manually."
+
+
 class PlotInfo:
     """Holds the info for the plot as an object"""
     def __init__(self):
@@ -76,6 +116,21 @@ class PlotInfo:
         self.filetype = 'png'
         self.width = 600
         self.height = 400
+        self.dpi = 1200
+        self.draft = False
+        self.draft_dpi = 72
+        self.tile_pixels = 4096*1024
+        self.overlap_passes = 20
+        self.image_size = 48
+        self.inputdir = ''
+        self.output = None
+        self.reproducible = False
+        self.energy_cache = EnergyCache()
+        self.precision = 1
+        self.unit_suffix = ''
+        self.lod = False
+        self.culled = 0
+        self.layout_time = None
         self.inunits = 'hartree'
         self.outunits = 'kj/mol'
         self.reference_line = 1
@@ -119,6 +174,42 @@ class PlotInfo:
         else:
             raise DimensionError(dimensions)
 
+    def set_draft(self, dpi=72, rename=True):
+        """Render a low dpi preview with the same label layout as the final
+        plot, saved alongside it as name_draft.format unless rename is False
+        (e.g. when the output filename was given explicitly)"""
+        if not is_positive_int(dpi) or int(dpi) == 0:
+            raise DimensionError(dpi)
+        self.draft = True
+        self.draft_dpi = int(dpi)
+        if rename:
+            name, ext = path.splitext(self.filename)
+            self.filename = name + '_draft' + ext
+
+    def set_labels(self, precision=1, suffix=''):
+        """Set the decimal places and units suffix of energy labels,
+        regenerating them if the data is already parsed"""
+        if not is_positive_int(precision):
+            raise FormatError(precision, "Precision {} not valid."
+                              .format(precision))
+        self.precision = int(precision)
+        self.unit_suffix = suffix
+        if hasattr(self, 'vectors'):
+            self.generate_vectors()
+
+    def set_lod(self, lod=True):
+        """Turn level of detail culling of crowded labels on or off,
+        regenerating the labels if the data is already parsed"""
+        self.lod = lod
+        if hasattr(self, 'vectors'):
+            self.generate_vectors()
+
+    def render_dpi(self):
+        """The dpi the output image is rasterized at"""
+        if self.draft:
+            return self.draft_dpi
+        return self.dpi
+
     def add_units(self, units):
         u = units.split(', ')
         if len(u) != 2:
@@ -148,6 +239,23 @@ class PlotInfo:
             raise FormatError(reference, "Error in reference line syntax: {}."
                               .format(reference))
 
+    def read_energy(self, energy):
+        """An energy can be given as the name of a Gaussian or ORCA output
+        file, optionally followed by :kind (scf, zpe, enthalpy or free), to use
+        the last such energy in it. Returns that energy in the input units,
+        or energy unchanged if it doesn't name a file."""
+        field = energy.strip().strip('"')
+        if field == '' or is_float(field):
+            return energy
+        name, sep, kind = field.rpartition(':')
+        if not sep or kind not in ENERGY_MARKERS:
+            name, kind = field, 'scf'
+        logfile = path.join(self.inputdir, name)
+        if not check_files_exist([logfile]):
+            return energy
+        return convert_units(self.energy_cache.get(logfile, kind),
+                             'hartrees', self.inunits)
+
     def parsedata(self, inputdata):
         """Parse the rest of the data into the Infolist"""
         self.plotdata = list()
@@ -159,7 +267,10 @@ class PlotInfo:
                     d.append(d[0] - 1)
                 while len(d) < 6:
                     d.append("")
-                
+                d[1] = self.read_energy(d[1])
+                if d[5].strip().strip('"'):
+                    d[5] = path.join(self.inputdir, d[5].strip().strip('"'))
+
                 self.plotdata.append(PlotEntry(d[0], d[3], d[4], d[1], d[5], d[2]))
 
         if self.reference_line > len(self.plotdata):
@@ -193,11 +304,58 @@ class PlotInfo:
             self.maxenergy = self.maxenergy - ref
             self.minenergy = self.minenergy - ref
 
+    def variant(self, outunits=None, reference=None, filetype=None):
+        """A copy of the plot in other output units, zeroed to another
+        reference line (0 for absolute values) or saved in another format.
+        The energies kept in input units are converted again rather than
+        reading the input, so a variant matches parsing the input with those
+        settings. The filename gets a suffix for each changed unit or
+        reference."""
+        v = copy.copy(self)
+        name, ext = path.splitext(self.filename)
+        if outunits is not None and outunits.lower().strip() != self.outunits:
+            v.outunits = outunits.lower().strip()
+            if v.outunits not in UNIT_LIST:
+                raise UnitError(outunits)
+            name += '_' + v.outunits.replace('/', '-')
+        if reference is not None and int(reference) != self.reference_line:
+            v.add_reference(reference)
+            if v.reference_line > len(self.plotdata):
+                raise FormatError(v.reference_line,
+                                  "Can't refrerence to line {}. Only {} lines "
+                                  "exist.".format(v.reference_line,
+                                                  len(self.plotdata)))
+            name += '_ref{}'.format(v.reference_line)
+        if filetype is not None:
+            v.filetype = check_format(filetype)
+        v.filename = name + '.' + v.filetype
+
+        v.plotdata = [copy.copy(p) for p in self.plotdata]
+        for p in v.plotdata:
+            p.energy = convert_units(p.inenergy, self.inunits, v.outunits)
+        if v.reference_line != 0:
+            ref = v.plotdata[v.reference_line - 1].energy
+            for p in v.plotdata:
+                p.energy = p.energy - ref
+        v.minenergy = min(p.energy for p in v.plotdata)
+        v.maxenergy = max(p.energy for p in v.plotdata)
+        if hasattr(self, 'vectors'):
+            v.generate_vectors()
+        return v
+
     def generate_vectors(self):
+        """Build the lines and labels to draw. self.deltas runs alongside
+        self.texts with the energy difference shown by each connector label,
+        or None for other labels."""
         self.vectors = list()
         self.texts = list()
+        self.deltas = list()
         self.dx = 24
         self.movex = self.dx/2*(self.maxenergy-self.minenergy)/self.height
+        labelled = self.lod_visible([(p.xindex, p.energy)
+                                     for p in self.plotdata])
+        self.labelled = labelled
+        self.culled = 2*labelled.count(False)
         #vectors are ([x,x], [y,y], 'colour,style')
         for i in range(len(self.plotdata)):
             pthis = self.plotdata[i]
@@ -209,14 +367,18 @@ class PlotInfo:
             point = [[pthis.xindex - 0.165, pthis.xindex + 0.165],
                      [pthis.energy, pthis.energy], '-', pthis.colour, 3]
             self.vectors.append(point)
-            t = [pthis.xindex, pthis.energy+self.movex, pthis.text,
-                 pthis.colour,'bottom', 'center', 'white', False]
-            self.texts.append(t)
-            engval = "{0:.1f}".format(pthis.energy)
-            t = [pthis.xindex,
-                 pthis.energy-self.movex, engval,
-                 pthis.colour, 'top','center', 'white', False]
-            self.texts.append(t)
+            if labelled[i]:
+                t = [pthis.xindex, pthis.energy+self.movex, pthis.text,
+                     pthis.colour,'bottom', 'center', 'white', False]
+                self.texts.append(t)
+                self.deltas.append(None)
+                engval = energy_label(pthis.energy, self.precision,
+                                      self.unit_suffix)
+                t = [pthis.xindex,
+                     pthis.energy-self.movex, engval,
+                     pthis.colour, 'top','center', 'white', False]
+                self.texts.append(t)
+                self.deltas.append(None)
             if pnext:
                 if pnext.connected_to != pthis.number:
                     pthis = self.plotdata[pnext.connected_to - 1]
@@ -224,7 +386,9 @@ class PlotInfo:
                         [pthis.energy, pnext.energy], '--', pnext.colour, 1]
                 self.vectors.append(point)
                 yax = (pthis.energy + pnext.energy)/2
-                engval = "({0:.1f})".format(pnext.energy - pthis.energy)
+                delta = round(pnext.energy - pthis.energy, self.precision)
+                engval = energy_label(delta, self.precision, self.unit_suffix,
+                                      True)
                 if pnext.energy - pthis.energy > 0:
                     va = 'top'
                 else:
@@ -232,35 +396,144 @@ class PlotInfo:
                 t = [pthis.xindex+0.55, yax, engval, pnext.colour, va, 'left',
                      None, True]
                 self.texts.append(t)
-
-    def find_overlaps(self):
+                self.deltas.append(delta)
+        if self.lod:
+            self.cull_deltas()
+            self.decimate_vectors()
+
+    def lod_visible(self, points):
+        """Pick which of the (x, energy) points keep their labels. Without
+        level of detail all do; with it, in each x column a label closer than
+        two label heights (LOD_LABEL_POINTS) above the last kept one is
+        dropped, so a column never holds more labels than fit."""
+        visible = [True]*len(points)
+        if not self.lod or not points:
+            return visible
+        gap = ((self.maxenergy - self.minenergy)*2*LOD_LABEL_POINTS /
+               (float(self.height)/self.dpi*72))
+        columns = dict()
+        for k, point in enumerate(points):
+            columns.setdefault(point[0], list()).append(k)
+        for column in columns.values():
+            last = None
+            for k in sorted(column, key=lambda k: points[k][1]):
+                if last is not None and points[k][1] - last < gap:
+                    visible[k] = False
+                else:
+                    last = points[k][1]
+        return visible
+
+    def cull_deltas(self):
+        """Drop energy difference labels crowded out of their column, so
+        they are never laid out or drawn"""
+        dk = [k for k in range(len(self.texts)) if self.texts[k][7]]
+        shown = self.lod_visible([(self.texts[k][0], self.texts[k][1])
+                                  for k in dk])
+        hidden = set(k for k, v in zip(dk, shown) if not v)
+        self.culled += len(hidden)
+        self.texts = [t for k, t in enumerate(self.texts) if k not in hidden]
+        self.deltas = [d for k, d in enumerate(self.deltas)
+                       if k not in hidden]
+
+    def decimate_vectors(self):
+        """Drop lines that would land on exactly the same pixels as one
+        already drawn"""
+        sx = float(self.width)/(self.maxxindex + 1)
+        sy = float(self.height)/((self.maxenergy - self.minenergy) or 1)
+        seen = set()
+        vectors = list()
+        for v in self.vectors:
+            key = (tuple(int(round(x*sx)) for x in v[0]),
+                   tuple(int(round((y - self.minenergy)*sy)) for y in v[1]),
+                   v[2], v[3])
+            if key not in seen:
+                seen.add(key)
+                vectors.append(v)
+        self.vectors = vectors
+
+    def text_rect(self, i):
+        """The rectangle [x1, y1, x2, y2] covered by text i, from its measured
+        extent"""
+        t = self.texts[i]
+        dx = t[8][1][0]-t[8][0][0]
+        dy = t[8][1][1]-t[8][0][1]
+        return [t[0], t[1], t[0] + dx, t[1] + dy]
+
+    def find_overlaps(self, max_passes=20, time_budget=None, check=None):
         """This iterates the self.texts and finds all instances of overlapping
-        text. Nudges up and down to try get around overlaps."""
-        more_overlaps = True
-        icounter = 0
-        while more_overlaps and icounter < 20:
-            more_overlaps = False
-            icounter += 1
-            for i in range(len(self.texts)):
-                for j in range(i):
-                    if not j == i:
-                        # rec=[x1, y1, x2, y2]
-                        dx = self.texts[i][8][1][0]-self.texts[i][8][0][0]
-                        dy = self.texts[i][8][1][1]-self.texts[i][8][0][1]
-                        reca = [self.texts[i][0],
-                                self.texts[i][1],
-                                self.texts[i][0] + dx,
-                                self.texts[i][1] + dy]
-                        dx = self.texts[j][8][1][0]-self.texts[j][8][0][0]
-                        dy = self.texts[j][8][1][1]-self.texts[j][8][0][1]
-                        recb = [self.texts[j][0],
-                                self.texts[j][1],
-                                self.texts[j][0] + dx,
-                                self.texts[j][1] + dy]
-                        if test_overlap(reca, recb):
-                            self.fix_overlap(i,j)
-                            more_overlaps=True
+        text. Nudges up and down to try get around overlaps.
+
+        Labels only move up and down, so the pairs sharing x extent are found
+        once. After the first pass only pairs with a label moved in the last
+        pass are checked again, and it stops as soon as a pass moves nothing,
+        after max_passes or after time_budget seconds. A pair that keeps
+        pushing back and forth is left alone as oscillating.
+
+        The time budget covers finding the pairs and the final check for
+        overlaps left, not just the passes: once out of time, only as many
+        pairs as there are labels are checked for the report. If given,
+        check is called as often as the budget and may raise to abandon the
+        solve, e.g. when a render is cancelled.
+
+        Returns an OverlapReport, also kept as self.overlaps."""
+        report = OverlapReport()
+        started = time.time()
+
+        def out_of_time():
+            if check is not None:
+                check()
+            if (time_budget is not None and
+                    time.time() - started > time_budget):
+                report.timed_out = True
+            return report.timed_out
+
+        candidates = overlap_candidates(
+            [self.text_rect(i) for i in range(len(self.texts))], out_of_time)
+        report.candidates = len(candidates)
+        directions = dict()
+        reversals = dict()
+        oscillating = set()
+        moved = None
+        while report.passes < max_passes and not out_of_time():
+            report.passes += 1
+            last_moved = moved
+            moved = set()
+            for k, (i, j) in enumerate(candidates):
+                if k % 256 == 255 and out_of_time():
+                    break
+                if (i, j) in oscillating:
+                    continue
+                if last_moved is not None and not (i in last_moved or
+                                                   j in last_moved):
+                    continue
+                report.pair_checks += 1
+                if not test_overlap(self.text_rect(i), self.text_rect(j)):
+                    continue
+                gap = self.texts[i][1] - self.texts[j][1]
+                if not self.fix_overlap(i, j):
+                    continue
+                moved.update((i, j))
+                # whichever label moved, did i go up relative to j
+                direction = self.texts[i][1] - self.texts[j][1] > gap
+                if (i, j) in directions and directions[i, j] != direction:
+                    reversals[i, j] = reversals.get((i, j), 0) + 1
+                    if reversals[i, j] >= 2:
+                        oscillating.add((i, j))
+                directions[i, j] = direction
+            if not moved and not report.timed_out:
+                report.converged = True
+                break
 
+        report.oscillating = sorted(oscillating)
+        checks = candidates
+        if report.timed_out:
+            checks = candidates[:len(self.texts)]
+        report.pair_checks += len(checks)
+        report.remaining = [(i, j) for i, j in checks
+                            if test_overlap(self.text_rect(i),
+                                            self.text_rect(j))]
+        self.overlaps = report
+        return report
 
     def fix_overlap(self, refa, refb):
         """Overlap fixes can be in multiple directions:
@@ -272,16 +545,17 @@ class PlotInfo:
                 move refa up, refb down <-- error also
         IF otherwise:
             move higher value up, lower value down
+        Returns whether anything was moved.
         """
         if self.texts[refa][7] == False and self.texts[refb][7] == False:
-            return
+            return False
         delta = finddelta(self.texts[refa][1], self.texts[refb][1],
                           self.textheight) + 0.1
 
         if self.texts[refa][7] == True and self.texts[refb][7] == True:
-            vala = clean_float(self.texts[refa][2])
-            valb = clean_float(self.texts[refb][2])
-            if vala == '' or valb == '' or vala == valb:
+            vala = self.deltas[refa]
+            valb = self.deltas[refb]
+            if vala is None or valb is None or vala == valb:
                 # +/- based on y
                 if self.texts[refa][1] > self.texts[refb][1]:
                     self.texts[refa][1] = self.texts[refa][1] + delta/2
@@ -315,55 +589,132 @@ class PlotInfo:
                 self.texts[refb][1] = self.texts[refb][1] - delta
             else:
                 self.texts[refb][1] = self.texts[refb][1] + delta
-        return
-
-def parse_file(ifile):
-    """Parse the file and get all the information needed."""
-    inputfile = read_clean_file(ifile)
-    inputdir = path.dirname(ifile)
+        return True
+
+def parse_lines(lines, inputdir=''):
+    """Parse plot data from any iterable of lines, such as a list, an open
+    file or sys.stdin. The output filename and images are taken relative to
+    inputdir."""
+    inputfile = clean_lines(lines)
+    if len(inputfile) < 5:
+        raise FormatError(len(inputfile), "Input has {} lines, needs a title, "
+                          "filename, dimensions, units and reference line."
+                          .format(len(inputfile)))
     plot = PlotInfo()
+    plot.inputdir = inputdir
+    plot.energy_cache = energy_cache(inputdir)
     plot.add_title(inputfile[0])
     plot.add_filename(os.path.join(inputdir, inputfile[1]))
     plot.add_dimensions(inputfile[2])
     plot.add_units(inputfile[3])
     plot.add_reference(inputfile[4])
     plot.parsedata(inputfile[5:])
+    try:
+        plot.energy_cache.save()
+    except FileAccessError:
+        pass  # the cache only saves rescanning logs next time
     plot.generate_vectors()
     return plot
 
 
-def prepare_plot(plot):
-    """Setup and save the plot"""
-    #start up plot
-    fig = plt.figure(frameon=False)
-    r = fig.canvas.get_renderer()
-    w = plot.width/plot.dpi
-    h = plot.height/plot.dpi
-    fig.set_size_inches(w, h)
-    plt.clf()
-    ax = plt.subplot()
+def parse_file(ifile):
+    """Parse the file and get all the information needed. A file of '-'
+    is read from stdin."""
+    if ifile == '-':
+        return parse_lines(sys.stdin)
+    return parse_lines(read_clean_file(ifile), path.dirname(ifile))
+
+
+def image_headroom(plot):
+    """Energy to add above plot.maxenergy so images drawn above the highest
+    entries fit inside the axes, or 0 if there are no images"""
+    if not any(p.image for p in plot.plotdata):
+        return 0.
+    axes_points = (float(plot.height)/plot.dpi*72 *
+                   (matplotlib.rcParams['figure.subplot.top'] -
+                    matplotlib.rcParams['figure.subplot.bottom']))
+    k = min((IMAGE_OFFSET + plot.image_size)/axes_points, 0.5)
+    return (plot.maxenergy - plot.minenergy)*k/(1 - k)
+
+
+def setup_axes(ax, plot):
+    """Set the data limits of the axes to fit the plot"""
     ax.set_xlim(0., plot.maxxindex+1)
-    ax.set_ylim(plot.minenergy, plot.maxenergy)
-    
-    for v in plot.vectors:
-        ax.plot(v[0], v[1], v[2], color = v[3], lw = v[4])
+    ax.set_ylim(plot.minenergy, plot.maxenergy + image_headroom(plot))
 
-    for t in plot.texts:
-        tbox = ax.text(t[0], t[1], t[2], color = t[3], va = t[4], ha = t[5], transform=ax.transData)
-        bb = tbox.get_window_extent(renderer=r)
-        t.append(ax.transData.inverted().transform(bb))
-        t[0] = ax.transData.inverted().transform(bb)[0][0]
-        t[1] = ax.transData.inverted().transform(bb)[0][1]
+
+def new_figure(plot, dpi, rows=None):
+    """Create a figure, Agg canvas and axes for the plot without touching
+    pyplot's global figure manager, so plots can be rendered from multiple
+    threads at once. Figure size in inches is fixed by the plot's own dpi, so
+    the layout is the same whatever dpi it is rasterized at.
+
+    If rows is given, the figure only covers that (top, height) strip of
+    pixels of the full plot at the plot's dpi."""
+    fig = Figure(frameon=False, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    w = float(plot.width)/plot.dpi
+    h = float(plot.height)/plot.dpi
+    fig.set_size_inches(w, h)
+    ax = fig.add_subplot(111)
+    if rows is not None:
+        top, height = rows
+        pos = ax.get_position()
+        bottom = plot.height - top - height
+        fig.set_size_inches(w, float(height)/plot.dpi)
+        ax.set_position([pos.x0, (pos.y0*plot.height - bottom)/height,
+                         pos.width, pos.height*plot.height/height])
+    setup_axes(ax, plot)
+    return fig, canvas, ax
+
+
+def layout_plot(plot, check=None):
+    """Measure the text on the plot and move labels so they don't overlap.
+    Always measured at LAYOUT_DPI so drafts match the final output, and each
+    distinct label is only measured once (see text_extent). If given, check
+    is called every so often and may raise to abandon the layout."""
+    fig, canvas, ax = new_figure(plot, LAYOUT_DPI)
+    r = canvas.get_renderer()
+
+    for k, t in enumerate(plot.texts):
+        if check is not None and k % 256 == 255:
+            check()
+        w, h = text_extent(t[2], fig, r)
+        px, py = ax.transData.transform((t[0], t[1]))
+        x0 = {'left': px, 'center': px - w/2., 'right': px - w}[t[5]]
+        y0 = {'bottom': py, 'center': py - h/2., 'top': py - h}[t[4]]
+        bb = ax.transData.inverted().transform([[x0, y0], [x0 + w, y0 + h]])
+        t.append(bb)
+        t[0] = bb[0][0]
+        t[1] = bb[0][1]
         t[4] = 'bottom'
         t[5] = 'left'
 
-    plot.find_overlaps()
-    plt.clf()
-    ax = plt.subplot()
-    ax.set_xlim(0., plot.maxxindex+1)
-    ax.set_ylim(plot.minenergy, plot.maxenergy)
-    plt.axis("off")
-    
+    plot.find_overlaps(plot.overlap_passes, plot.layout_time, check)
+
+
+def draw_images(plot, ax, dpi):
+    """Draw each labelled entry's image, plot.image_size points across,
+    IMAGE_OFFSET points above its entry. Decoded images come from
+    IMAGE_CACHE already scaled for dpi."""
+    pixels = int(round(plot.image_size*dpi/72.))
+    for p, labelled in zip(plot.plotdata, plot.labelled):
+        if p.image is None or not labelled:
+            continue
+        arr = IMAGE_CACHE.get(p.image, pixels)
+        oi = OffsetImage(arr, zoom=float(plot.image_size)/max(arr.shape[:2]))
+        ab = AnnotationBbox(oi, (p.xindex, p.energy), xybox=(0., IMAGE_OFFSET),
+                            xycoords='data', boxcoords='offset points',
+                            box_alignment=(0.5, 0.), frameon=False)
+        ab.set_zorder(4)
+        ax.add_artist(ab)
+
+
+def draw_plot(plot, ax, dpi):
+    """Draw the laid out vectors, texts and images onto the axes"""
+    ax.axis("off")
+    draw_images(plot, ax, dpi)
+
     for v in plot.vectors:
         ax.plot(v[0], v[1], v[2], color = v[3], lw = v[4], zorder=1)
 
@@ -375,27 +726,201 @@ def prepare_plot(plot):
             ax.text(t[0], t[1], t[2], color = t[3], va = t[4], ha = t[5],
                     zorder=3)
 
-    #plt.show()
-    plt.savefig(plot.filename, format=plot.filetype)#, bbox_inches='tight')
+
+def tile_rows(plot):
+    """Rows per strip that keep a full width strip within plot.tile_pixels"""
+    return max(1, plot.tile_pixels // plot.width)
+
+
+def save_tiled(plot):
+    """Rasterize the plot in full width horizontal strips of at most
+    plot.tile_pixels pixels and stream them into the png, so only one strip
+    is held in memory at a time.
+
+    Agg clips each line to its strip before dashing, so dashed connectors
+    crossing a strip edge restart their dash pattern there; solid lines,
+    text and images match an untiled render."""
+    def strips():
+        step = tile_rows(plot)
+        for top in range(0, plot.height, step):
+            rows = min(step, plot.height - top)
+            fig, canvas, ax = new_figure(plot, plot.dpi, (top, rows))
+            draw_plot(plot, ax, plot.dpi)
+            canvas.draw()
+            yield rgba_array(canvas.buffer_rgba(), canvas.get_width_height(),
+                             plot.width, rows)
+    write_png_strips(output_target(plot), plot.width, plot.height, strips(),
+                     plot.dpi)
+
+
+def output_target(plot):
+    """The open file or filename the plot is saved to"""
+    if plot.output is not None:
+        return plot.output
+    return plot.filename
+
+
+def tiled(plot):
+    """Whether the plot is written to png in strips"""
+    return (not plot.draft and plot.filetype == 'png' and plot.tile_pixels and
+            plot.width*plot.height > plot.tile_pixels)
+
+
+def draw_figure(plot, check=None):
+    """Lay out and draw the plot, returning the canvas ready to be saved.
+    check is passed on to layout_plot."""
+    layout_plot(plot, check)
+    fig, canvas, ax = new_figure(plot, plot.render_dpi())
+    draw_plot(plot, ax, plot.render_dpi())
+    return canvas
+
+
+def save_figure(plot, canvas):
+    """Encode and write a drawn plot to plot.output if set, or its file.
+    With plot.reproducible, metadata, ids and dates are fixed so the same
+    plot always gives the same bytes."""
+    if tiled(plot):
+        save_tiled(plot)
+        return
+    kwargs = dict()
+    if plot.reproducible and plot.filetype in REPRODUCIBLE_METADATA:
+        kwargs['metadata'] = REPRODUCIBLE_METADATA[plot.filetype]
+    with output_settings(plot.filetype, plot.reproducible):
+        canvas.print_figure(output_target(plot), format=plot.filetype,
+                            dpi=plot.render_dpi(), **kwargs)#, bbox_inches='tight')
+
+
+def prepare_plot(plot):
+    """Setup and save the plot"""
+    save_figure(plot, draw_figure(plot))
+
+
+def plot_files(files, load=parse_file, workers=2, expand=None):
+    """Plot several input files. Up to workers upcoming files are read and
+    parsed with load on a pool of workers threads, and drawn plots are
+    encoded and written by a background thread, while the current plot is
+    laid out. If given, expand turns each parsed plot into the list of plots
+    to save. Returns the plots in the order of files."""
+    pool = ThreadPool(workers)
+    saving = Queue(maxsize=workers)
+    errors = list()
+
+    def writer():
+        while True:
+            item = saving.get()
+            if item is None:
+                break
+            try:
+                save_figure(*item)
+            except Exception as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    plots = list()
+    files = iter(files)
+    pending = deque(pool.apply_async(load, (f,))
+                    for f in islice(files, workers))
+    try:
+        while pending:
+            parsed = pending.popleft().get()
+            for f in islice(files, 1):
+                pending.append(pool.apply_async(load, (f,)))
+            for plot in expand(parsed) if expand else [parsed]:
+                saving.put((plot, draw_figure(plot)))
+                plots.append(plot)
+    finally:
+        saving.put(None)
+        thread.join()
+        pool.close()
+        pool.join()
+    if errors:
+        raise errors[0]
+    return plots
 
 
 def main():
     """Run the code"""
     parser = argparse.ArgumentParser("Usage: %prog [options]")
-    parser.add_argument('file',
-                        help="Read plot data from input FILE")
+    parser.add_argument('file', nargs='+',
+                        help="Read plot data from input FILE(s), - for stdin")
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="Save to FILE instead of the filename in the "
+                             "input, - for stdout (one input only)")
+    parser.add_argument('--draft', nargs='?', type=int, const=72,
+                        metavar='DPI',
+                        help="Save a low dpi preview (default 72) with the "
+                             "final layout as name_draft.format, or to the "
+                             "--output file")
+    parser.add_argument('--layout-time', type=float, metavar='SECONDS',
+                        help="Stop moving overlapping labels after SECONDS")
+    parser.add_argument('--precision', type=int, default=1,
+                        help="Decimal places shown on energy labels")
+    parser.add_argument('--units-label', default='', metavar='SUFFIX',
+                        help="Text appended to energy labels, e.g. ' kJ/mol'")
+    parser.add_argument('--lod', action='store_true',
+                        help="Leave out labels too crowded to read")
+    parser.add_argument('--reproducible', action='store_true',
+                        help="Fix metadata and ids so identical input gives "
+                             "byte identical output")
+    parser.add_argument('--units', nargs='+', metavar='UNITS',
+                        help="Also save the plot in each of these output "
+                             "units")
+    parser.add_argument('--reference', nargs='+', type=int, metavar='LINE',
+                        help="Also save the plot zeroed to each of these "
+                             "lines")
+    parser.add_argument('--format', nargs='+', metavar='FORMAT',
+                        help="Save the plot(s) in each of these file formats")
+    parser.add_argument('-j', '--jobs', type=int, default=2,
+                        help="Threads reading input files ahead of plotting")
 
     args = parser.parse_args()
     
-    infile = args.file
+    variants = args.units or args.reference or args.format
+    if args.output and len(args.file) > 1:
+        parser.error("--output needs a single input file")
+    if args.output == '-' and variants:
+        parser.error("Can't write several variants to stdout")
+    #messages go to stderr when the plot itself goes to stdout
+    log = sys.stderr if args.output == '-' else sys.stdout
+
+    infiles = args.file
     #check file exists, if not request file.
-    if not check_files_exist([infile]):
+    if not check_files_exist([f for f in infiles if f != '-']):
         exit()
     #file is good. let's go!
 
-    plot = parse_file(infile)
-    prepare_plot(plot)
-    print "OK!"
+    def load(infile):
+        plot = parse_file(infile)
+        if args.output == '-':
+            plot.output = getattr(sys.stdout, 'buffer', sys.stdout)
+        elif args.output:
+            plot.add_filename(args.output)
+        if args.draft is not None:
+            plot.set_draft(args.draft, not args.output)
+        plot.layout_time = args.layout_time
+        if args.precision != 1 or args.units_label:
+            plot.set_labels(args.precision, args.units_label)
+        if args.lod:
+            plot.set_lod()
+        plot.reproducible = args.reproducible
+        return plot
+
+    def expand(plot):
+        plots = list()
+        for u in [None] + (args.units or []):
+            for ref in [None] + (args.reference or []):
+                for fmt in args.format or [None]:
+                    v = plot.variant(u, ref, fmt)
+                    if v.filename not in [p.filename for p in plots]:
+                        plots.append(v)
+        return plots
+
+    for plot in plot_files(infiles, load, args.jobs,
+                           expand if variants else None):
+        if plot.overlaps.remaining or plot.overlaps.timed_out:
+            print("{}: {}".format(plot.filename, plot.overlaps), file=log)
+    print("OK!", file=log)
     
 
 if __name__ == '__main__':
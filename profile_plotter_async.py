@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+#Profile Plotter asyncio API
+#Programmer: Philip Bulsink
+#Licence: BSD
+#Renders reaction profiles from asyncio code on a bounded pool of threads,
+#so parsing, layout and rasterization don't block the event loop.
+#Needs Python 3.7 or later.
+
+import asyncio
+import copy
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from profile_plotter import *
+from profile_plotter_helpers import *
+
+
+class QueueFullError(Error):
+    """Too many plots are already waiting to render"""
+    def __init__(self, size):
+        self.size = size
+        self.msg = "Render queue of {} plots is full.".format(size)
+
+
+class RenderCancelled(Error):
+    """Stops a render whose caller has gone away"""
+    def __init__(self):
+        self.msg = "Render cancelled."
+
+
+def render_spec(spec, output, cancelled):
+    """Parse (if needed) and render spec, which is a parsed PlotInfo, an input
+    filename or the lines of an input. A PlotInfo is left untouched: a copy
+    with freshly generated labels is laid out and saved instead, so the
+    same one can be rendered from several coroutines at once. Checks between
+    stages, and while laying out labels, whether the caller has cancelled.
+    Returns the rendered PlotInfo."""
+    def check():
+        if cancelled.is_set():
+            raise RenderCancelled()
+
+    check()
+    if isinstance(spec, PlotInfo):
+        plot = copy.copy(spec)
+        plot.generate_vectors()
+    elif isinstance(spec, str):
+        plot = parse_file(spec)
+    else:
+        plot = parse_lines(spec)
+    if output is not None:
+        plot.output = output
+    check()
+    canvas = draw_figure(plot, check)
+    check()
+    save_figure(plot, canvas)
+    return plot
+
+
+def release_slot(loop, slots):
+    """Give a slot back to slots from the worker thread a render finished
+    on"""
+    try:
+        loop.call_soon_threadsafe(slots.release)
+    except RuntimeError:
+        # the loop has closed, and its slots with it
+        pass
+
+
+class Renderer:
+    """Renders plots for asyncio code on a pool of workers threads.
+
+    At most workers + queue_size renders are running or waiting at once.
+    When that many are in flight, render waits for a free slot, or raises
+    QueueFullError straight away if block is False. A render that timed out
+    or was cancelled keeps its slot until its thread has stopped. The limit
+    applies per event loop, as asyncio semaphores belong to one loop; the
+    pool of worker threads is shared by all of them."""
+    def __init__(self, workers=4, queue_size=16, block=True):
+        self.executor = ThreadPoolExecutor(workers)
+        self.size = workers + queue_size
+        self.block = block
+        self.slots = weakref.WeakKeyDictionary()
+
+    async def render(self, spec, output=None, timeout=None):
+        """Render spec (see render_spec), saving to output if given instead
+        of the plot's filename. Raises asyncio.TimeoutError after timeout
+        seconds. On timeout or cancellation the render is abandoned the next
+        time its thread checks."""
+        loop = asyncio.get_running_loop()
+        slots = self.slots.get(loop)
+        if slots is None:
+            slots = self.slots[loop] = asyncio.Semaphore(self.size)
+        if not self.block and slots.locked():
+            raise QueueFullError(self.size)
+        await slots.acquire()
+        cancelled = threading.Event()
+        try:
+            job = self.executor.submit(render_spec, spec, output, cancelled)
+        except Exception:
+            slots.release()
+            raise
+        job.add_done_callback(lambda job: release_slot(loop, slots))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(job), timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            cancelled.set()
+            raise
+
+    def close(self, wait=True):
+        """Shut down the worker threads"""
+        self.executor.shutdown(wait)
+
+
+_renderer = None
+
+
+async def render_profile(spec, output=None, timeout=None):
+    """Render spec on a shared default Renderer, see Renderer.render"""
+    global _renderer
+    if _renderer is None:
+        _renderer = Renderer()
+    return await _renderer.render(spec, output, timeout)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""profile_plotter_async_test
+
+Only runs on Python 3.7 or later, where asyncio has what the API needs."""
+
+import unittest
+import sys
+import threading
+import time
+from io import BytesIO
+
+ASYNC = sys.version_info >= (3, 7)
+if ASYNC:
+    import asyncio
+    from profile_plotter_async import *
+
+INPUT = [
+    'TestPlot',
+    'testasync.png',
+    '600, 400, 100',
+    'hartrees, kj/mol',
+    '1',
+    '1, -100, "1", , black',
+    '2, -99.98, "TS2", , black',
+    '3, -100.01, "Int3", , black',
+]
+
+
+def gated(lines, gate):
+    """Yields lines once gate is set, holding up a render that parses them"""
+    gate.wait()
+    for line in lines:
+        yield line
+
+
+@unittest.skipUnless(ASYNC, "needs Python 3.7+")
+class TestAsyncRender(unittest.TestCase):
+    """Test the asyncio rendering API"""
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.renderer = Renderer(workers=2, queue_size=1)
+
+    def tearDown(self):
+        self.renderer.close()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_render(self):
+        """Renders lines of input to an in memory file"""
+        out = BytesIO()
+        plot = self.loop.run_until_complete(
+            self.renderer.render(INPUT, out, timeout=30))
+        self.assertEqual(plot.title, 'TestPlot')
+        self.assertEqual(out.getvalue()[:4], b'\x89PNG')
+
+    def test_concurrent(self):
+        """Several renders run together and each completes"""
+        outs = [BytesIO() for n in range(3)]
+        plots = self.loop.run_until_complete(asyncio.gather(
+            *[self.renderer.render(INPUT, out) for out in outs]))
+        self.assertEqual(len(plots), 3)
+        self.assertTrue(all(out.getvalue() for out in outs))
+
+    def test_shared_plot(self):
+        """One PlotInfo rendered from several coroutines is left unchanged"""
+        plot = parse_lines(INPUT)
+        texts = [list(t) for t in plot.texts]
+        outs = [BytesIO() for n in range(4)]
+        rendered = self.loop.run_until_complete(asyncio.gather(
+            *[self.renderer.render(plot, out) for out in outs]))
+        self.assertEqual(plot.texts, texts)
+        self.assertIsNone(plot.output)
+        for r, out in zip(rendered, outs):
+            self.assertIsNot(r, plot)
+            self.assertTrue(all(len(t) == 9 for t in r.texts))
+            self.assertEqual(out.getvalue()[:4], b'\x89PNG')
+
+    def test_separate_loops(self):
+        """The shared renderer works from one event loop after another"""
+        for n in range(2):
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                plots = loop.run_until_complete(asyncio.gather(
+                    *[render_profile(INPUT, BytesIO()) for k in range(5)]))
+                self.assertEqual(len(plots), 5)
+            finally:
+                loop.close()
+        asyncio.set_event_loop(self.loop)
+
+    def test_queue_full(self):
+        """Without blocking, a full queue refuses more work"""
+        self.renderer.block = False
+        self.renderer.size = 1
+        outs = [BytesIO() for n in range(2)]
+        results = self.loop.run_until_complete(asyncio.gather(
+            *[self.renderer.render(INPUT, out) for out in outs],
+            return_exceptions=True))
+        self.assertIsInstance(results[0], PlotInfo)
+        self.assertIsInstance(results[1], QueueFullError)
+
+    def test_timeout(self):
+        """A render past its timeout is abandoned"""
+        with self.assertRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(
+                self.renderer.render(INPUT, BytesIO(), timeout=0))
+
+    def test_timeout_keeps_slot(self):
+        """A timed out render holds its slot until its thread stops"""
+        self.renderer.close()
+        self.renderer = Renderer(workers=1, queue_size=0, block=False)
+        gate = threading.Event()
+        try:
+            with self.assertRaises(asyncio.TimeoutError):
+                self.loop.run_until_complete(self.renderer.render(
+                    gated(INPUT, gate), BytesIO(), timeout=0.05))
+            with self.assertRaises(QueueFullError):
+                self.loop.run_until_complete(
+                    self.renderer.render(INPUT, BytesIO(), timeout=5))
+        finally:
+            gate.set()
+        slots = self.renderer.slots[self.loop]
+        started = time.time()
+        while slots.locked() and time.time() - started < 10:
+            self.loop.run_until_complete(asyncio.sleep(0.01))
+        plot = self.loop.run_until_complete(
+            self.renderer.render(INPUT, BytesIO()))
+        self.assertEqual(plot.title, 'TestPlot')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -1,10 +1,23 @@
 #!/usr/bin/env python
 #profile_plotter_helpers
 
+import json
+import mmap
 import os
+import re
+import struct
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from matplotlib.image import imread
+from matplotlib.text import Text
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 COLOURS ={  # Colours from IEC60757
     'black': ['black', 'bk'],
@@ -26,6 +39,11 @@ COLOURS ={  # Colours from IEC60757
     'maroon': ['maroon', 'mr'],
     'olive': ['olive', 'ov'],
     }
+READ_MODE = 'rU' if sys.version_info[0] < 3 else 'r'  # universal newlines
+LAYOUT_DPI = 72  # dpi text is measured at for laying out labels
+IMAGE_OFFSET = 24.  # points from an entry to the bottom of its image
+LOD_LABEL_POINTS = 14  # height of one label line for level of detail culling
+LABEL_CACHE_SIZE = 4096  # labels kept by energy_label and text_extent
 UNIT_LIST=['hartrees','kj/mol', 'kcal/mol', 'ev', 'cm-1']
 CONVERSION = {
     'hartrees':[1, 2625.50, 627.51, 27.212, 219474],
@@ -34,6 +52,25 @@ CONVERSION = {
     'ev': [0.036749, 96.485, 23.061, 1, 8065.5],
     'cm-1': [0.0000045563, 0.011963, 0.0028591, 0.00012398, 1]
     }
+ENERGY_MARKERS = {  # Gaussian and ORCA lines ending in an energy in hartrees
+    'scf': [b'SCF Done:', b'FINAL SINGLE POINT ENERGY'],
+    'zpe': [b'Sum of electronic and zero-point Energies='],
+    'enthalpy': [b'Sum of electronic and thermal Enthalpies=',
+                 b'Total Enthalpy'],
+    'free': [b'Sum of electronic and thermal Free Energies=',
+             b'Final Gibbs free energy'],
+    }
+REPRODUCIBLE_SALT = 'profile_plotter'  # svg id salt for reproducible output
+REPRODUCIBLE_METADATA = {  # fixed in place of matplotlib's version and date
+    'png': {'Software': 'profile_plotter'},
+    'pdf': {'Creator': 'profile_plotter', 'Producer': 'profile_plotter',
+            'CreationDate': None},
+    'svg': {'Date': None},
+    'ps': {'Creator': 'profile_plotter'},
+    'eps': {'Creator': 'profile_plotter'},
+    }
+GLOBAL_SETTING_FORMATS = ['svg', 'svgz', 'ps', 'eps']  # see output_settings
+ENERGY_CACHE_FILE = '.profile_plotter_energies.json'
 
 
 class Error(Exception):
@@ -87,11 +124,16 @@ def check_files_exist(filelist):
 def read_clean_file(filename):
     """Reads in a file, cleaning line endings and returning a list of lines"""
     try:
-        with open(filename, 'rU') as f:
+        with open(filename, READ_MODE) as f:
             ilines = f.readlines()
     except Exception as e:
         raise FileAccessError("Error reading file {}.".format(filename), e)
 
+    return clean_lines(ilines)
+
+
+def clean_lines(ilines):
+    """Cleans line endings from any iterable of lines, returning a list"""
     lines = list()
     for line in ilines:
         lines.append(line.strip())
@@ -102,13 +144,12 @@ def read_clean_file(filename):
 def check_format(fmt):
     """Compare the requested format to the list of available. If not good,
     return png (default) or svg, or raise error."""
-    fig = plt.figure()
-    formats = fig.canvas.get_supported_filetypes()
-    if formats.has_key(fmt):
+    formats = FigureCanvasAgg(Figure()).get_supported_filetypes()
+    if fmt in formats:
         return fmt
-    elif formats.has_key('png'):
+    elif 'png' in formats:
         return 'png'
-    elif formats.has_key('svg'):
+    elif 'svg' in formats:
         return 'png'
     else:
         raise FormatError(
@@ -116,6 +157,208 @@ def check_format(fmt):
             'Unknown file format. Could not find alternate format.')
 
 
+def read_image(filename):
+    """Decode an image file to an array"""
+    try:
+        return imread(filename)
+    except Exception as e:
+        raise FileAccessError("Error reading image {}.".format(filename), e)
+
+
+def fit_image(arr, size):
+    """Shrink an image array by averaging whole blocks of pixels until its
+    larger side is no more than twice size pixels"""
+    k = max(arr.shape[:2]) // size
+    if k < 2:
+        return arr
+    h = arr.shape[0] // k * k
+    w = arr.shape[1] // k * k
+    blocks = arr[:h, :w].reshape((h // k, k, w // k, k) + arr.shape[2:])
+    return blocks.mean(axis=(1, 3)).astype(arr.dtype)
+
+
+class ImageCache:
+    """LRU cache of decoded images fitted to a size, keyed on the file's
+    path, modification time and the size"""
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename, size):
+        """Return the image in filename fitted to size pixels"""
+        key = (os.path.abspath(filename), os.path.getmtime(filename), size)
+        with self.lock:
+            if key in self.images:
+                self.hits += 1
+                arr = self.images.pop(key)
+                self.images[key] = arr
+                return arr
+        arr = fit_image(read_image(filename), size)
+        with self.lock:
+            self.misses += 1
+            self.images[key] = arr
+            while len(self.images) > self.maxsize:
+                self.images.popitem(last=False)
+        return arr
+
+    def clear(self):
+        """Forget all cached images"""
+        with self.lock:
+            self.images.clear()
+
+
+IMAGE_CACHE = ImageCache()
+
+
+_extents = dict()
+
+
+def text_extent(text, fig, renderer):
+    """Width and height in pixels of text drawn with the default font,
+    cached so each distinct label is only measured once per dpi"""
+    key = (text, renderer.dpi)
+    extent = _extents.get(key)
+    if extent is None:
+        t = Text(0, 0, text)
+        t.set_figure(fig)
+        bb = t.get_window_extent(renderer)
+        extent = (bb.width, bb.height)
+        if len(_extents) >= LABEL_CACHE_SIZE:
+            _extents.clear()
+        _extents[key] = extent
+    return extent
+
+
+def read_log_energy(filename, kind='scf'):
+    """Find the last energy of kind (see ENERGY_MARKERS) in a Gaussian or
+    ORCA output file. The file is memory mapped and searched backwards from
+    the end, so long logs are not read line by line."""
+    if kind not in ENERGY_MARKERS:
+        raise FormatError(kind, "Unknown energy kind {}.".format(kind))
+    try:
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise FormatError(filename, "{} is empty.".format(filename))
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                found = -1
+                for marker in ENERGY_MARKERS[kind]:
+                    pos = mm.rfind(marker)
+                    if pos > found:
+                        found = pos
+                        start = pos + len(marker)
+                if found < 0:
+                    raise FormatError(filename, "No {} energy found in {}."
+                                      .format(kind, filename))
+                end = mm.find(b'\n', start)
+                line = mm[start:end if end >= 0 else len(mm)]
+            finally:
+                mm.close()
+    except (IOError, OSError) as e:
+        raise FileAccessError("Error reading file {}.".format(filename), e)
+    value = re.search(br'-?\d+\.\d+', line)
+    if value is None:
+        raise FormatError(filename, "No {} energy found in {}."
+                          .format(kind, filename))
+    return float(value.group(0))
+
+
+class EnergyCache:
+    """Energies read from output files, keyed on path and kind and reused
+    while the file's modification time and size are unchanged. If given a
+    filename, the cache is loaded from and saved to it as json between runs."""
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.energies = dict()
+        self.lock = threading.Lock()
+        self.changed = False
+        self.scans = 0
+        if filename and os.path.isfile(filename):
+            try:
+                with open(filename) as f:
+                    for entry in json.load(f):
+                        self.energies[entry[0], entry[1]] = entry[2:]
+            except (IOError, ValueError, IndexError):
+                self.energies = dict()
+
+    def get(self, filename, kind='scf'):
+        """Return the last energy of kind in filename, in hartrees"""
+        st = os.stat(filename)
+        key = (os.path.abspath(filename), kind)
+        with self.lock:
+            entry = self.energies.get(key)
+            if entry is not None and entry[:2] == [st.st_mtime, st.st_size]:
+                return entry[2]
+        energy = read_log_energy(filename, kind)
+        with self.lock:
+            self.energies[key] = [st.st_mtime, st.st_size, energy]
+            self.changed = True
+            self.scans += 1
+        return energy
+
+    def save(self):
+        """Write the cache to its file, if it has one and anything changed"""
+        with self.lock:
+            if not self.filename or not self.changed:
+                return
+            entries = [list(key) + entry
+                       for key, entry in sorted(self.energies.items())]
+            try:
+                with open(self.filename, 'w') as f:
+                    json.dump(entries, f)
+            except IOError as e:
+                raise FileAccessError("Error writing file {}."
+                                      .format(self.filename), e)
+            self.changed = False
+
+
+_energy_caches = dict()
+_energy_caches_lock = threading.Lock()
+
+
+def energy_cache(directory):
+    """The EnergyCache kept in ENERGY_CACHE_FILE in directory, loaded once
+    per run"""
+    filename = os.path.abspath(os.path.join(directory, ENERGY_CACHE_FILE))
+    with _energy_caches_lock:
+        if filename not in _energy_caches:
+            _energy_caches[filename] = EnergyCache(filename)
+        return _energy_caches[filename]
+
+
+_settings_lock = threading.Lock()
+
+
+@contextmanager
+def output_settings(filetype, reproducible=False):
+    """Context to save a figure of filetype in. The svg id salt and the ps
+    date only come from process wide settings (rcParams['svg.hashsalt'] and
+    SOURCE_DATE_EPOCH), so for reproducible output they are fixed for the
+    save and restored after. Every save of those formats holds a lock, so
+    saves in other threads never see the fixed values."""
+    if filetype not in GLOBAL_SETTING_FORMATS:
+        yield
+        return
+    with _settings_lock:
+        if not reproducible:
+            yield
+            return
+        salt = matplotlib.rcParams['svg.hashsalt']
+        epoch = os.environ.get('SOURCE_DATE_EPOCH')
+        matplotlib.rcParams['svg.hashsalt'] = REPRODUCIBLE_SALT
+        if epoch is None:
+            os.environ['SOURCE_DATE_EPOCH'] = '0'
+        try:
+            yield
+        finally:
+            matplotlib.rcParams['svg.hashsalt'] = salt
+            if epoch is None:
+                del os.environ['SOURCE_DATE_EPOCH']
+
+
 def is_int(num):
     """Test the input num to be an int. Return True/False"""
     try:
@@ -163,6 +406,26 @@ def convert_units(value, inunit, outunit):
     return value * CONVERSION[inunit][UNIT_LIST.index(outunit)]
 
 
+_labels = dict()
+
+
+def energy_label(value, precision=1, suffix='', delta=False):
+    """Format an energy for display to precision decimal places with a units
+    suffix, bracketed if it is a difference. Labels are cached on the rounded
+    value, so repeated energies are only formatted once. Negative zero is
+    shown as zero, as it compares equal to it and shares its cache entry."""
+    key = (round(value, precision) + 0.0, precision, suffix, delta)
+    label = _labels.get(key)
+    if label is None:
+        if len(_labels) >= LABEL_CACHE_SIZE:
+            _labels.clear()
+        label = "{0:.{1}f}{2}".format(key[0], precision, suffix)
+        if delta:
+            label = "(" + label + ")"
+        _labels[key] = label
+    return label
+
+
 def write_file(filename, lines):
     """Writes a file 'filename' from lines"""
     try:
@@ -184,7 +447,7 @@ def test_overlap(reca, recb):
         tmp = recb[0]
         recb[0] = recb[2]
         recb[2] = tmp
-    if recb[2] <= reca[0] or recb[0] >= recb[2]:
+    if recb[2] <= reca[0] or recb[0] >= reca[2]:
         return False
     if not reca[1] <= reca[3]:
         tmp = reca[1]
@@ -199,10 +462,76 @@ def test_overlap(reca, recb):
     return True
 
 
+def overlap_candidates(rects, stop=None):
+    """Takes a list of rectangles (x1, y1, x2, y2) and returns the sorted
+    (i, j) pairs, j < i, whose x ranges overlap. Sweeps along x so pairs far
+    apart are never compared. If given, stop is called every 64 rectangles
+    and the sweep gives up, returning the pairs found so far, once it returns
+    True."""
+    order = sorted(range(len(rects)), key=lambda k: min(rects[k][0],
+                                                        rects[k][2]))
+    pairs = list()
+    active = list()
+    for n, k in enumerate(order):
+        if stop is not None and n % 64 == 63 and stop():
+            break
+        x1 = min(rects[k][0], rects[k][2])
+        active = [a for a in active if max(rects[a][0], rects[a][2]) > x1]
+        for a in active:
+            pairs.append((max(a, k), min(a, k)))
+        active.append(k)
+    return sorted(pairs)
+
+
 def finddelta(da, db, ddim):
     """Finds the amound of dimension to move based on the two inputs and the
     shared dimension width/height of each"""
     if da < db:
         return abs(da)+ddim-abs(db)
     else:
-        return abs(db)+ddim-abs(da)
\ No newline at end of file
+        return abs(db)+ddim-abs(da)
+
+
+def rgba_array(buf, size, width, height):
+    """Turn an Agg RGBA buffer of size (w, h) into a (height, width, 4) array,
+    padding or cropping any pixel lost to rounding the figure size"""
+    w, h = size
+    arr = np.frombuffer(buf, np.uint8).reshape(h, w, 4)
+    out = np.zeros((height, width, 4), np.uint8)
+    out[:min(h, height), :min(w, width)] = arr[:height, :width]
+    return out
+
+
+def write_png_strips(filename, width, height, strips, dpi=None):
+    """Writes an RGBA png 'filename' (or an open binary file) from an
+    iterable of (rows, width, 4) arrays, compressing each strip as it comes
+    so the whole image is never held in memory"""
+    def chunk(f, tag, data):
+        f.write(struct.pack('>I', len(data)) + tag + data +
+                struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    def write_png(f):
+        f.write(b'\x89PNG\r\n\x1a\n')
+        chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6,
+                                      0, 0, 0))
+        if dpi:
+            ppm = int(round(dpi/0.0254))
+            chunk(f, b'pHYs', struct.pack('>IIB', ppm, ppm, 1))
+        z = zlib.compressobj()
+        for s in strips:
+            rows = np.zeros((s.shape[0], width*4 + 1), np.uint8)
+            rows[:, 1:] = s.reshape(s.shape[0], width*4)
+            data = z.compress(rows.tobytes())
+            if data:
+                chunk(f, b'IDAT', data)
+        chunk(f, b'IDAT', z.flush())
+        chunk(f, b'IEND', b'')
+
+    if hasattr(filename, 'write'):
+        write_png(filename)
+        return
+    try:
+        with open(filename, 'wb') as f:
+            write_png(f)
+    except IOError as e:
+        raise FileAccessError("Error writing file {}.".format(filename), e)
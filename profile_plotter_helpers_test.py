@@ -4,6 +4,7 @@
 import unittest
 import os
 from profile_plotter_helpers import *
+import numpy as np
 import matplotlib.pyplot as plt
 
 class TestSimpleFuncs(unittest.TestCase):
@@ -124,6 +125,89 @@ class TestSimpleFuncs(unittest.TestCase):
         """Test the is_float function with a bad string"""
         self.assertEqual(is_float('one'), False)
 
+    def test_energy_label(self):
+        """Energies format to the given precision and suffix"""
+        self.assertEqual(energy_label(-12.345), '-12.3')
+        self.assertEqual(energy_label(5, 2, ' eV', True), '(5.00 eV)')
+
+    def test_energy_label_cached(self):
+        """Values rounding to the same label share one cached string"""
+        self.assertIs(energy_label(1.01), energy_label(0.99))
+
+    def test_energy_label_negative_zero(self):
+        """-0.0 gets the same label whichever is formatted first"""
+        self.assertEqual(energy_label(-0.0, 3), '0.000')
+        self.assertEqual(energy_label(0.0, 3), '0.000')
+        self.assertEqual(energy_label(-0.0001, 3, '', True), '(0.000)')
+
+    def test_fit_image(self):
+        """Large images are shrunk by whole blocks"""
+        arr = np.ones((100, 60, 4))
+        self.assertEqual(fit_image(arr, 20).shape, (20, 12, 4))
+        self.assertIs(fit_image(arr, 64), arr)
+
+    def test_image_cache(self):
+        """The same image and size is only decoded once"""
+        write_png_strips('testimage.png', 8, 8,
+                         [np.zeros((8, 8, 4), np.uint8)])
+        cache = ImageCache(maxsize=1)
+        try:
+            a = cache.get('testimage.png', 4)
+            self.assertIs(cache.get('testimage.png', 4), a)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertEqual(a.shape, (4, 4, 4))
+            cache.get('testimage.png', 8)
+            self.assertEqual(len(cache.images), 1)
+        finally:
+            os.remove('testimage.png')
+
+    def test_text_extent_cached(self):
+        """Each label is measured once"""
+        fig = Figure()
+        r = FigureCanvasAgg(fig).get_renderer()
+        extent = text_extent('(12.3)', fig, r)
+        self.assertGreater(extent[0], extent[1])
+        self.assertIs(text_extent('(12.3)', fig, r), extent)
+
+    def test_read_log_energy(self):
+        """The last energy of a kind is read from Gaussian and ORCA logs"""
+        write_file('testg.log', [
+            ' SCF Done:  E(RB3LYP) =  -100.123456     A.U. after   12 cycles',
+            ' SCF Done:  E(RB3LYP) =  -100.654321     A.U. after    5 cycles',
+            ' Sum of electronic and thermal Free Energies=   -100.600000'])
+        write_file('testo.out', [
+            'FINAL SINGLE POINT ENERGY      -76.400000000',
+            'Final Gibbs free energy         ...    -76.380000 Eh'])
+        try:
+            self.assertEqual(read_log_energy('testg.log'), -100.654321)
+            self.assertEqual(read_log_energy('testg.log', 'free'), -100.6)
+            self.assertEqual(read_log_energy('testo.out'), -76.4)
+            self.assertEqual(read_log_energy('testo.out', 'free'), -76.38)
+            with self.assertRaises(FormatError):
+                read_log_energy('testo.out', 'zpe')
+        finally:
+            os.remove('testg.log')
+            os.remove('testo.out')
+
+    def test_energy_cache(self):
+        """Logs are only scanned again when they change, across runs"""
+        write_file('testg.log', [' SCF Done:  E(RHF) =  -1.5   A.U.'])
+        try:
+            cache = EnergyCache('testcache.json')
+            self.assertEqual(cache.get('testg.log'), -1.5)
+            self.assertEqual(cache.get('testg.log'), -1.5)
+            self.assertEqual(cache.scans, 1)
+            cache.save()
+            cache = EnergyCache('testcache.json')
+            self.assertEqual(cache.get('testg.log'), -1.5)
+            self.assertEqual(cache.scans, 0)
+            write_file('testg.log', [' SCF Done:  E(RHF) =  -1.25  A.U.'])
+            self.assertEqual(cache.get('testg.log'), -1.25)
+            self.assertEqual(cache.scans, 1)
+        finally:
+            os.remove('testg.log')
+            os.remove('testcache.json')
+
     def test_no_overlap(self):
         """Test that a rectangle isn't overlapping"""
         reca = [4, 3, 8, 5]
@@ -139,6 +223,17 @@ class TestSimpleFuncs(unittest.TestCase):
         reca = [4, 3, 8, 5]
         recb = [4, 2, 3, 6]
         self.assertEqual(test_overlap(reca, recb), False)
+
+    def test_no_overlap_right(self):
+        """Rectangle to the right at the same height isn't overlapping"""
+        reca = [4, 3, 8, 5]
+        recb = [9, 3, 10, 5]
+        self.assertEqual(test_overlap(reca, recb), False)
+
+    def test_overlap_candidates(self):
+        """Only pairs sharing x extent are candidates"""
+        rects = [[0, 0, 1, 1], [5, 0, 6, 1], [0.5, 3, 2, 4], [1.5, 0, 2.5, 9]]
+        self.assertEqual(overlap_candidates(rects), [(2, 0), (3, 2)])
     
 
 if __name__ == '__main__':
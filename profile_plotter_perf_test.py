@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""profile_plotter_perf_test
+
+Performance tests. These bound counts (pair checks, open figures, memory)
+rather than timings, so they fail the same way on any machine."""
+
+import unittest
+import gc
+import os
+import subprocess
+import sys
+from matplotlib._pylab_helpers import Gcf
+from matplotlib.figure import Figure
+from profile_plotter import *
+from profile_plotter_helpers import *
+
+
+def profile_input(n, filename):
+    """Lines of an input file with n states in a zig-zag chain"""
+    lines = ['PerfPlot', filename, '1600, 800, 100', 'kj/mol, kj/mol', '1']
+    for k in range(1, n + 1):
+        lines.append('{0}, {1}, "S{0}", , black'.format(k, (k % 7) * 10.0))
+    return lines
+
+
+def live_figures():
+    gc.collect()
+    return len([o for o in gc.get_objects() if isinstance(o, Figure)])
+
+
+class TestPerformance(unittest.TestCase):
+    """Bounds on the work done in hot paths"""
+    def setUp(self):
+        self.files = ['perfinput.txt', 'perfplot.png']
+
+    def tearDown(self):
+        for f in self.files:
+            if os.path.isfile(f):
+                os.remove(f)
+
+    def test_overlap_pair_checks(self):
+        """find_overlaps compares labels near each other, not every pair"""
+        write_file('perfinput.txt', profile_input(300, 'perfplot.png'))
+        plot = parse_file('perfinput.txt')
+        layout_plot(plot)
+        report = plot.overlaps
+        n = len(plot.texts)
+        # every comparison made, including the final check for the report
+        self.assertLessEqual(report.pair_checks,
+                             report.candidates * (report.passes + 1))
+        self.assertLess(report.pair_checks, 20 * n * (report.passes + 1))
+        self.assertLess(report.pair_checks, n * (n - 1) / 2)
+        self.assertLessEqual(report.passes, plot.overlap_passes)
+
+    def test_no_figures_left_open(self):
+        """prepare_plot leaves nothing behind in pyplot or in memory"""
+        write_file('perfinput.txt', profile_input(20, 'perfplot.png'))
+        plot = parse_file('perfinput.txt')
+        before = live_figures()
+        prepare_plot(plot)
+        self.assertEqual(Gcf.get_num_fig_managers(), 0)
+        self.assertEqual(live_figures(), before)
+
+    def test_parse_memory(self):
+        """Peak memory parsing a 10k line input stays bounded"""
+        write_file('perfinput.txt', profile_input(10000, 'perfplot.png'))
+        try:
+            import tracemalloc
+            script = [
+                'import tracemalloc',
+                'from profile_plotter import parse_file',
+                'tracemalloc.start()',
+                'plot = parse_file("perfinput.txt")',
+                'print(tracemalloc.get_traced_memory()[1])',
+            ]
+        except ImportError:
+            try:
+                import resource
+            except ImportError:
+                self.skipTest("no way to measure peak memory here")
+            # ru_maxrss is in bytes on macOS, kB elsewhere
+            scale = 1 if sys.platform == 'darwin' else 1024
+            script = [
+                'import resource',
+                'from profile_plotter import parse_file',
+                'base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss',
+                'plot = parse_file("perfinput.txt")',
+                'peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss',
+                'print((peak - base) * {})'.format(scale),
+            ]
+        used = int(subprocess.check_output([sys.executable, '-c',
+                                            '\n'.join(script)]))
+        self.assertLess(used, 64 * 1024 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -3,6 +3,11 @@
 
 import unittest
 import os
+from multiprocessing.pool import ThreadPool
+from io import BytesIO, StringIO
+from matplotlib._pylab_helpers import Gcf
+from matplotlib.image import imread
+import numpy as np
 from profile_plotter import *
 from profile_plotter_helpers import *
 
@@ -66,6 +71,14 @@ class TestPlotInfo(unittest.TestCase):
         self.plotI.add_dimensions("600, 400, 200")
         self.assertEqual(self.plotI.dpi, 200)
 
+    def test_draft_keeps_given_name(self):
+        """Drafts only rename the filename taken from the input"""
+        self.plotI.add_filename("test1.png")
+        self.plotI.set_draft(50, rename=False)
+        self.assertEqual(self.plotI.filename, 'test1.png')
+        self.plotI.set_draft(50)
+        self.assertEqual(self.plotI.filename, 'test1_draft.png')
+
     def test_add_ok_inunits(self):
         """Test adding good input units"""
         self.plotI.add_inunits("hartrees")
@@ -122,6 +135,191 @@ class TestPlotInfo(unittest.TestCase):
                          [1, 2205.42, '"1"', 'black', 'bottom', 'center',
                           'white', False])
 
+    def test_generating_deltas(self):
+        """Differences are kept as numbers next to their labels"""
+        self.plotI.add_reference(1)
+        self.plotI.add_inunits('kj/mol')
+        self.plotI.add_outunits('kj/mol')
+        self.plotI.parsedata(self.indata)
+        self.plotI.generate_vectors()
+        self.assertEqual(len(self.plotI.deltas), len(self.plotI.texts))
+        self.assertEqual(self.plotI.deltas[:3], [None, None, 20.0])
+        self.assertEqual(self.plotI.texts[2][2], '(20.0)')
+
+    def test_set_labels(self):
+        """Labels regenerate with a new precision and suffix"""
+        self.plotI.add_reference(1)
+        self.plotI.add_inunits('kj/mol')
+        self.plotI.add_outunits('kj/mol')
+        self.plotI.parsedata(self.indata)
+        self.plotI.generate_vectors()
+        self.plotI.set_labels(2, ' kJ')
+        self.assertEqual(self.plotI.texts[1][2], '0.00 kJ')
+        self.assertEqual(self.plotI.texts[2][2], '(20.00 kJ)')
+
+    def test_variant_units(self):
+        """Variants rescale the parsed energies into other units"""
+        self.plotI.add_filename('test1.png')
+        self.plotI.add_reference(1)
+        self.plotI.add_inunits('kj/mol')
+        self.plotI.add_outunits('kj/mol')
+        self.plotI.parsedata(self.indata)
+        self.plotI.generate_vectors()
+        v = self.plotI.variant('kcal/mol', None, 'svg')
+        self.assertEqual(v.filename, 'test1_kcal-mol.svg')
+        self.assertAlmostEqual(v.plotdata[1].energy, 20 * 0.23901)
+        self.assertAlmostEqual(v.minenergy, -30 * 0.23901)
+        self.assertEqual(v.texts[2][2], '(4.8)')
+        self.assertEqual(self.plotI.plotdata[1].energy, 20)
+
+    def test_variant_reference(self):
+        """Variants can be zeroed to another line, or absolute"""
+        self.plotI.add_filename('test1.png')
+        self.plotI.add_reference(1)
+        self.plotI.add_inunits('kj/mol')
+        self.plotI.add_outunits('kj/mol')
+        self.plotI.parsedata(self.indata)
+        v = self.plotI.variant(reference=3)
+        self.assertEqual(v.filename, 'test1_ref3.png')
+        self.assertEqual(v.plotdata[0].energy, 5)
+        v = v.variant(reference=0)
+        self.assertEqual(v.plotdata[0].energy, -100)
+        self.assertEqual(v.maxenergy, -72)
+
+    def test_variant_matches_parse(self):
+        """A variant gives the energies parsing in its units would"""
+        self.plotI.add_reference(0)
+        self.plotI.add_inunits('hartrees')
+        self.plotI.parsedata(self.indata)
+        v = self.plotI.variant('kcal/mol')
+        parsed = PlotInfo()
+        parsed.add_reference(0)
+        parsed.add_inunits('hartrees')
+        parsed.add_outunits('kcal/mol')
+        parsed.parsedata(self.indata)
+        self.assertEqual([p.energy for p in v.plotdata],
+                         [p.energy for p in parsed.plotdata])
+        self.assertEqual(v.variant('kj/mol').plotdata[0].energy,
+                         self.plotI.plotdata[0].energy)
+
+    def test_lod(self):
+        """Level of detail keeps a crowded column to what fits"""
+        indata = ['1, 0, "1", , black']
+        indata += ['{0}, {1}, "{0}", 1, black'.format(n, n * 0.01)
+                   for n in range(2, 502)]
+        self.plotI.add_dimensions('600, 400, 100')
+        self.plotI.add_reference(1)
+        self.plotI.add_inunits('kj/mol')
+        self.plotI.add_outunits('kj/mol')
+        self.plotI.parsedata(indata)
+        self.plotI.generate_vectors()
+        self.assertEqual(len(self.plotI.texts), 1502)
+        self.plotI.set_lod()
+        self.assertLess(len(self.plotI.texts), 60)
+        self.assertEqual(len(self.plotI.texts) + self.plotI.culled, 1502)
+        self.assertEqual(len(self.plotI.deltas), len(self.plotI.texts))
+        self.assertLess(len(self.plotI.vectors), 1001)
+
+
+class TestFindOverlaps(unittest.TestCase):
+    """Test the overlap solver on hand made text boxes"""
+    def setUp(self):
+        self.plotI = PlotInfo()
+        self.plotI.textheight = 1.0
+        self.plotI.deltas = list()
+
+    def text(self, x, y, value, delta=True):
+        self.plotI.deltas.append(clean_float(value) if delta else None)
+        return [x, y, value, 'black', 'bottom', 'left', None, delta,
+                [[x, y], [x + 1, y + 1]]]
+
+    def test_converges(self):
+        """Stops early once a pass moves nothing"""
+        self.plotI.texts = [self.text(0, 0, '(1.0)'),
+                            self.text(0.5, 0.5, '(-1.0)'),
+                            self.text(5, 0, '(2.0)')]
+        report = self.plotI.find_overlaps()
+        self.assertTrue(report.converged)
+        self.assertEqual(report.remaining, [])
+        self.assertLess(report.passes, 20)
+        self.assertGreater(self.plotI.texts[0][1], self.plotI.texts[1][1])
+
+    def test_fixed_labels_reported(self):
+        """Overlapping labels that can't move are reported"""
+        self.plotI.texts = [self.text(0, 0, 'A', False),
+                            self.text(0.5, 0.5, 'B', False)]
+        report = self.plotI.find_overlaps()
+        self.assertTrue(report.converged)
+        self.assertEqual(report.passes, 1)
+        self.assertEqual(report.remaining, [(1, 0)])
+
+    def test_pair_checks(self):
+        """Each candidate pair is checked once in the first pass and once
+        for the report"""
+        self.plotI.texts = [self.text(0, 0, 'A', False),
+                            self.text(5, 0, 'B', False),
+                            self.text(0.5, 3, 'C', False)]
+        report = self.plotI.find_overlaps()
+        self.assertEqual(report.candidates, 1)
+        self.assertEqual(report.pair_checks, 2)
+
+    def test_oscillation_fixed_label(self):
+        """Reversals count when only the movable label of a pair moves"""
+        self.plotI.texts = [self.text(0.5, 0.5, '(1.0)'),
+                            self.text(0, 0, 'A', False)]
+        self.plotI.fix_overlap = self.flip
+        self.flips = 0
+        report = self.plotI.find_overlaps()
+        self.assertEqual(report.oscillating, [(1, 0)])
+        self.assertLess(report.passes, 20)
+
+    def flip(self, refa, refb):
+        """Nudge the movable refb alternately up and down, keeping the
+        overlap"""
+        self.flips += 1
+        self.plotI.texts[refb][1] += 0.1 if self.flips % 2 else -0.1
+        return True
+
+    def test_pass_limit(self):
+        """Never runs more than max_passes"""
+        self.plotI.texts = [self.text(0, 0.1 * k, '(1.0)') for k in range(8)]
+        report = self.plotI.find_overlaps(max_passes=2)
+        self.assertLessEqual(report.passes, 2)
+
+    def test_time_budget(self):
+        """Out of time before the first pass"""
+        self.plotI.texts = [self.text(0, 0, '(1.0)'),
+                            self.text(0.5, 0.5, '(-1.0)')]
+        report = self.plotI.find_overlaps(time_budget=-1)
+        self.assertTrue(report.timed_out)
+        self.assertEqual(report.passes, 0)
+        self.assertEqual(report.remaining, [(1, 0)])
+
+    def test_time_budget_bounds_checks(self):
+        """Out of time, a crowded column is not swept or rescanned in full"""
+        self.plotI.texts = [self.text(0, 0.1 * k, 'A', False)
+                            for k in range(1000)]
+        report = self.plotI.find_overlaps(time_budget=-1)
+        self.assertTrue(report.timed_out)
+        self.assertFalse(report.converged)
+        self.assertLess(report.candidates, 64 * 64)
+        self.assertLessEqual(report.pair_checks, len(self.plotI.texts))
+        self.assertTrue(str(report).startswith("Out of time"))
+
+    def test_check_abandons(self):
+        """A check that raises stops the solve part way through"""
+        self.plotI.texts = [self.text(0, 0.1 * k, '(1.0)')
+                            for k in range(1000)]
+        self.checks = 0
+        with self.assertRaises(FormatError):
+            self.plotI.find_overlaps(check=self.stop_after_one)
+        self.assertEqual(self.checks, 2)
+
+    def stop_after_one(self):
+        self.checks += 1
+        if self.checks > 1:
+            raise FormatError(self.checks, "Stopped.")
+
 
 class TestParseFile(unittest.TestCase):
     """Test the PlotEntry functions"""
@@ -183,6 +381,202 @@ class TestParseFile(unittest.TestCase):
                          [[0.835, 1.165], [-8.0, -8.0], '-', 'black', 3])
 
 
+class TestPreparePlot(unittest.TestCase):
+    """Test rendering plots to file"""
+    def setUp(self):
+        self.inputfile = [
+            'TestPlot',
+            'testrender.png',
+            '600, 400, 100',
+            'hartrees, kj/mol',
+            '1',
+            '1, -100, "1", , black',
+            '2, -99.98, "TS2", , black',
+            '3, -100.01, "Int3", , black',
+            '4, -99.99, "TS4", 2, blue',
+        ]
+        self.outfiles = list()
+
+    def tearDown(self):
+        for f in ['inputrender.txt'] + self.outfiles:
+            if os.path.isfile(f):
+                os.remove(f)
+
+    def make_plot(self, n):
+        self.inputfile[1] = 'testrender{}.png'.format(n)
+        self.outfiles.append(self.inputfile[1])
+        write_file('inputrender.txt', self.inputfile)
+        return parse_file('inputrender.txt')
+
+    def test_no_pyplot_figures(self):
+        "rendering should not leave figures in pyplot's manager"
+        prepare_plot(self.make_plot(0))
+        self.assertTrue(check_files_exist(self.outfiles))
+        self.assertEqual(Gcf.get_num_fig_managers(), 0)
+
+    def test_threaded_render(self):
+        "several plots can be rendered at once from a thread pool"
+        plots = [self.make_plot(n) for n in range(4)]
+        pool = ThreadPool(4)
+        pool.map(prepare_plot, plots)
+        pool.close()
+        pool.join()
+        self.assertTrue(check_files_exist(self.outfiles))
+
+    def test_plot_files(self):
+        "batches are parsed ahead and written in the background, in order"
+        infiles = list()
+        for n in range(3):
+            self.make_plot(n)
+            infiles.append('inputrender{}.txt'.format(n))
+            self.outfiles.append(infiles[-1])
+            os.rename('inputrender.txt', infiles[-1])
+        plots = plot_files(infiles)
+        self.assertEqual([p.filename for p in plots],
+                         ['testrender0.png', 'testrender1.png',
+                          'testrender2.png'])
+        self.assertTrue(check_files_exist(self.outfiles))
+
+    def test_plot_files_lookahead(self):
+        "only a few files are parsed ahead, and a failure stops the batch"
+        loaded = list()
+
+        def load(n):
+            loaded.append(n)
+            if n == 1:
+                raise FormatError(n, "Bad input.")
+            lines = list(self.inputfile)
+            lines[1] = 'testrender{}.png'.format(n)
+            return parse_lines(lines)
+        with self.assertRaises(FormatError):
+            plot_files(range(20), load, workers=2)
+        self.outfiles += ['testrender{}.png'.format(n) for n in loaded]
+        self.assertLessEqual(len(loaded), 4)
+
+    def test_render_image(self):
+        "images attached to entries are drawn whole, from the cache"
+        red = np.zeros((16, 16, 4), np.uint8)
+        red[:, :, 0] = red[:, :, 3] = 255
+        write_png_strips('testimage.png', 16, 16, [red])
+        self.outfiles.append('testimage.png')
+        self.inputfile[6] = '2, -99.98, "TS2", , black, "testimage.png"'
+        plot = self.make_plot(0)
+        self.assertEqual(plot.plotdata[1].image, 'testimage.png')
+        misses = IMAGE_CACHE.misses
+        prepare_plot(plot)
+        prepare_plot(plot)
+        self.assertTrue(check_files_exist(self.outfiles))
+        self.assertEqual(IMAGE_CACHE.misses, misses + 1)
+        # TS2 is the highest entry; its image must not be cut off at the top
+        out = imread(plot.filename)
+        shown = ((out[:, :, 0] > 0.9) & (out[:, :, 1] < 0.1) &
+                 (out[:, :, 3] > 0.9)).sum()
+        side = plot.image_size*plot.dpi/72.
+        self.assertGreater(shown, 0.9*side*side)
+
+    def test_parse_lines(self):
+        "plots parse from a stream of lines as well as a file"
+        stream = StringIO(u'\n'.join(self.inputfile) + u'\n')
+        plot = parse_lines(stream, 'somewhere')
+        self.assertEqual(plot.filename, os.path.join('somewhere',
+                                                     'testrender.png'))
+        self.assertEqual(len(plot.plotdata), 4)
+
+    def test_parse_logs(self):
+        "energies can be read from output files named in the input"
+        write_file('testts2.log', [' SCF Done:  E(RHF) =  -99.98  A.U.'])
+        self.outfiles += ['testts2.log', ENERGY_CACHE_FILE]
+        self.inputfile[6] = '2, testts2.log, "TS2", , black'
+        plot = self.make_plot(0)
+        self.assertAlmostEqual(plot.plotdata[1].energy, 0.02 * 2625.50)
+        self.assertTrue(check_files_exist([ENERGY_CACHE_FILE]))
+
+    def test_parse_logs_unwritable_cache(self):
+        "a cache that can't be saved doesn't stop the parse"
+        write_file('testts3.log', [' SCF Done:  E(RHF) =  -99.97  A.U.'])
+        self.outfiles.append('testts3.log')
+        os.mkdir(ENERGY_CACHE_FILE)
+        try:
+            self.inputfile[6] = '2, testts3.log, "TS2", , black'
+            plot = self.make_plot(0)
+            self.assertAlmostEqual(plot.plotdata[1].energy, 0.03 * 2625.50)
+        finally:
+            os.rmdir(ENERGY_CACHE_FILE)
+        # the unsaved entry is written out once the file can be
+        energy_cache('').save()
+        self.outfiles.append(ENERGY_CACHE_FILE)
+
+    def test_parse_short(self):
+        "input without the header lines is a format error"
+        with self.assertRaises(FormatError):
+            parse_lines(self.inputfile[:3])
+
+    def test_render_to_stream(self):
+        "plots can be saved to an open file, whole or in strips"
+        for tile_pixels in [0, 64 * 600]:
+            plot = parse_lines(self.inputfile)
+            plot.tile_pixels = tile_pixels
+            plot.output = BytesIO()
+            prepare_plot(plot)
+            self.assertEqual(plot.output.getvalue()[:8], b'\x89PNG\r\n\x1a\n')
+        self.assertFalse(check_files_exist(['testrender.png']))
+
+    def test_reproducible(self):
+        "reproducible renders of the same input are byte identical"
+        salt = matplotlib.rcParams['svg.hashsalt']
+        epoch = os.environ.get('SOURCE_DATE_EPOCH')
+        for fmt in ['png', 'svg', 'pdf', 'eps']:
+            outputs = list()
+            for n in range(2):
+                plot = parse_lines(self.inputfile)
+                plot.add_filename('testrender.' + fmt)
+                plot.reproducible = True
+                plot.output = BytesIO()
+                prepare_plot(plot)
+                outputs.append(plot.output.getvalue())
+            self.assertEqual(outputs[0], outputs[1])
+        # nothing process wide is left changed
+        self.assertEqual(matplotlib.rcParams['svg.hashsalt'], salt)
+        self.assertEqual(os.environ.get('SOURCE_DATE_EPOCH'), epoch)
+
+    def test_draft_size(self):
+        "drafts are rasterized at the draft dpi, with the same layout"
+        final = self.make_plot(0)
+        prepare_plot(final)
+        draft = self.make_plot(1)
+        draft.set_draft(50)
+        self.outfiles.append(draft.filename)
+        prepare_plot(draft)
+        self.assertEqual(draft.filename, 'testrender1_draft.png')
+        self.assertEqual(imread(draft.filename).shape, (200, 300, 4))
+        self.assertEqual([t[:2] for t in draft.texts],
+                         [t[:2] for t in final.texts])
+
+    def test_tiled_render(self):
+        "png written in strips matches the one written in one go"
+        plots = [self.make_plot(0), self.make_plot(1)]
+        for plot in plots:
+            # dashes restart at strip edges (see save_tiled), so compare solid
+            for v in plot.vectors:
+                v[2] = '-'
+        plots[1].tile_pixels = 64 * 600
+        self.assertFalse(tiled(plots[0]))
+        self.assertTrue(tiled(plots[1]))
+        for plot in plots:
+            prepare_plot(plot)
+        a = imread(plots[0].filename)
+        b = imread(plots[1].filename)
+        self.assertEqual(a.shape, b.shape)
+        # at most a few edge pixels snap differently at strip boundaries
+        self.assertLess((abs(a - b).max(axis=2) > 0.01).sum(), 5)
+
+    def test_tiled_wide(self):
+        "wide plots are tiled by pixel count, not only by height"
+        plot = self.make_plot(0)
+        plot.width, plot.height = 30000, 150
+        plot.tile_pixels = 30000 * 40
+        self.assertTrue(tiled(plot))
+        self.assertEqual(tile_rows(plot), 40)
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
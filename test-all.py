@@ -1,9 +1,15 @@
 #!/usr/bin/env python
-"""Testall.py"""
+"""Testall.py
 
+Run with --perf to also run the performance tests."""
+
+import sys
 from unittest import TestLoader, TextTestRunner, TestSuite
-from profile_plotter_test import TestParseFile, TestPlotEntry, TestPlotInfo
+from profile_plotter_test import TestParseFile, TestPlotEntry, TestPlotInfo, \
+    TestFindOverlaps, TestPreparePlot
 from profile_plotter_helpers_test import TestSimpleFuncs
+from profile_plotter_perf_test import TestPerformance
+from profile_plotter_async_test import TestAsyncRender
 
 if __name__ == "__main__":
     loader = TestLoader()
@@ -11,8 +17,13 @@ if __name__ == "__main__":
         loader.loadTestsFromTestCase(TestParseFile),
         loader.loadTestsFromTestCase(TestPlotEntry),
         loader.loadTestsFromTestCase(TestPlotInfo),
-        loader.loadTestsFromTestCase(TestSimpleFuncs)
+        loader.loadTestsFromTestCase(TestFindOverlaps),
+        loader.loadTestsFromTestCase(TestPreparePlot),
+        loader.loadTestsFromTestCase(TestSimpleFuncs),
+        loader.loadTestsFromTestCase(TestAsyncRender)
                 ))
+    if '--perf' in sys.argv:
+        suite.addTest(loader.loadTestsFromTestCase(TestPerformance))
 
     runner = TextTestRunner(verbosity = 2)
     runner.run(suite)